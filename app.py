@@ -1,18 +1,45 @@
 """Simple assignment grader using Azure OpenAI."""
 
 import os
+import asyncio
 import json
 import re
+import hashlib
+import shutil
 import tempfile
-from flask import Flask, render_template, request, jsonify
+import threading
+import multiprocessing
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import httpx
+from flask import Flask, Request, render_template, request, jsonify
 from werkzeug.utils import secure_filename
+import zipfile
 import nbformat
-from docx import Document
-from openai import AzureOpenAI
+from lxml import etree
+from openai import AsyncAzureOpenAI
 from dotenv import load_dotenv
+from grader_cache import LLMCache, MemoryBackend, build_cache_from_env
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover
+    tiktoken = None
+
+try:
+    from llmlingua import PromptCompressor
+except ImportError:  # pragma: no cover
+    PromptCompressor = None
 
 try:
     from pypdf import PdfReader
+    import pdf_worker
 except ImportError:  # pragma: no cover
     PdfReader = None
 
@@ -21,6 +48,11 @@ try:
 except ImportError:  # pragma: no cover
     Presentation = None
 
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # pragma: no cover
+    CalamineWorkbook = None
+
 try:
     from openpyxl import load_workbook
 except ImportError:  # pragma: no cover
@@ -28,15 +60,348 @@ except ImportError:  # pragma: no cover
 
 load_dotenv()
 
+# Copy uploads in 1 MB chunks instead of Werkzeug's 16 KB default
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class DiskUploadRequest(Request):
+    """Request that spools every uploaded file straight to disk."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Werkzeug keeps uploads under 500 KB in memory; with many concurrent
+        # graders that adds up, so write every part to disk as it arrives.
+        # Keeping the extension lets extract_text read the spooled file in place;
+        # it is deleted when the request closes its files.
+        suffix = os.path.splitext(secure_filename(filename or ''))[1].lower()
+        return tempfile.NamedTemporaryFile('wb+', prefix='grader-upload-', suffix=suffix)
+
+
 # Handle deployment at /grader-gpt subdirectory
 # When deployed, nginx will strip /grader-gpt prefix before forwarding
 app = Flask(__name__)
+app.request_class = DiskUploadRequest
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
-app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
 
 # Application root - will be /grader-gpt when deployed
 APPLICATION_ROOT = os.getenv('APPLICATION_ROOT', '/')
 
+# Azure OpenAI settings are read once at startup
+AZURE_OPENAI_API_KEY = os.getenv('AZURE_OPENAI_API_KEY')
+# Ensure endpoint doesn't have trailing slash
+AZURE_OPENAI_ENDPOINT = (os.getenv('AZURE_OPENAI_ENDPOINT') or '').rstrip('/')
+AZURE_OPENAI_API_VERSION = os.getenv('AZURE_OPENAI_API_VERSION', '2024-12-01-preview')
+AZURE_OPENAI_DEPLOYMENT_NAME = os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME', 'gpt-4')
+
+# Optional stronger deployment that regrades a submission when the primary
+# deployment's answer is malformed or its deductions don't add up to the score,
+# so AZURE_OPENAI_DEPLOYMENT_NAME can point at a cheaper model such as gpt-4o-mini
+AZURE_OPENAI_ESCALATION_DEPLOYMENT = os.getenv('AZURE_OPENAI_ESCALATION_DEPLOYMENT') or None
+# Points by which sum(deductions) may miss 100 - score before escalating
+GRADING_ESCALATION_TOLERANCE = float(os.getenv('GRADING_ESCALATION_TOLERANCE', '5'))
+
+# Maximum number of student submissions graded against Azure at the same time
+AZURE_CONCURRENCY = int(os.getenv('AZURE_CONCURRENCY', '8'))
+
+# Upper bound on generated tokens; the grading JSON schema needs far fewer
+GRADING_MAX_COMPLETION_TOKENS = int(os.getenv('GRADING_MAX_COMPLETION_TOKENS', '800'))
+
+# Grading runs on one long-lived event loop so the pooled client and the
+# concurrency limit are shared by every request
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+_client_lock = threading.Lock()
+azure_semaphore = asyncio.Semaphore(AZURE_CONCURRENCY)
+
+# Extensions read as plain text by extract_text
+_TEXT_LIKE_EXTS = frozenset({
+    '.txt', '.md', '.csv', '.json', '.jsonl', '.yaml', '.yml', '.xml',
+    '.html', '.htm', '.py', '.js', '.ts', '.java', '.c', '.cpp', '.h',
+    '.sql', '.r', '.tex', '.sh', '.bat', '.log', '.ini', '.cfg', '.toml',
+    '.rtf', '.doc'
+})
+
+# WordprocessingML tags read by the .docx extractor
+_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_BODY, _W_P, _W_T, _W_TAB, _W_BR, _W_CR = (
+    f'{_W_NS}{tag}' for tag in ('body', 'p', 't', 'tab', 'br', 'cr')
+)
+_W_TYPE = f'{_W_NS}type'
+# document.xml comes from an untrusted upload: never expand entities or fetch
+# network resources (older lxml resolves external entities by default)
+_DOCX_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+# Run-level text of a paragraph, in document order. Text boxes are skipped, as
+# python-docx does: their w:txbxContent sits inside a run, and an
+# mc:AlternateContent wrapper would otherwise yield the Choice and the Fallback copy.
+_W_RUN_TEXT = etree.XPath(
+    './/w:r[not(ancestor::w:txbxContent)]/*[self::w:t or self::w:tab or self::w:br or self::w:cr]',
+    namespaces={'w': _W_NS[1:-1]}
+)
+
+# PDFs with at least this many pages have their text extracted in parallel
+PDF_PARALLEL_MIN_PAGES = 4
+_pdf_executor = None
+_pdf_executor_lock = threading.Lock()
+
+# Token budget for each of the base solution and a student submission; longer
+# documents are cut so one oversized notebook can't overflow the context window
+GRADING_MAX_INPUT_TOKENS = int(os.getenv('GRADING_MAX_INPUT_TOKENS', '8000'))
+_token_encoding = None
+_token_encoding_lock = threading.Lock()
+
+# Optional LLMLingua compression of a long base solution before it is sent for grading.
+# Set PROMPT_COMPRESSION_MODEL (e.g. microsoft/llmlingua-2-bert-base-multilingual-cased-meetingbank)
+# to enable it; base solutions shorter than the threshold (in characters) are sent as-is.
+# Student submissions are never compressed: dropped tokens would change the code being graded.
+PROMPT_COMPRESSION_MODEL = os.getenv('PROMPT_COMPRESSION_MODEL')
+PROMPT_COMPRESSION_THRESHOLD = int(os.getenv('PROMPT_COMPRESSION_THRESHOLD', '20000'))
+PROMPT_COMPRESSION_RATE = float(os.getenv('PROMPT_COMPRESSION_RATE', '0.5'))
+# LLMLingua loads onto CUDA by default; most deployments of this app are CPU-only
+PROMPT_COMPRESSION_DEVICE = os.getenv('PROMPT_COMPRESSION_DEVICE', 'cpu')
+_prompt_compressor = None
+_prompt_compressor_failed = False
+_prompt_compressor_lock = threading.Lock()
+
+# Longest prompt/response text echoed back in a debug payload
+DEBUG_TEXT_LIMIT = 4096
+
+# Static grading instructions, shared by every request. Kept terse on purpose:
+# they are sent with every call, so every word is paid for in input tokens.
+SYSTEM_MESSAGE = "You are a grading assistant. Always respond with valid JSON."
+GRADING_GUIDELINES = """Grade the student submission against the reference solution.
+
+GUIDELINES: no penalty for style or variable naming; give partial credit for reasonable approaches; judge correctness, logic and completeness, not exact matching.
+CRITERIA: 1) correct core logic and results 2) completeness 3) edge cases 4) clarity of explanations/comments (if any).
+SCORING: start at 100; deduct only for clear mistakes or missing parts; small issue 1-5 pts, conceptual error more; do not invent issues. sum(deductions.points) = 100 - score.
+OUTPUT: valid JSON only:
+{"score": int, "feedback": "brief constructive summary of strengths and weaknesses", "question_feedback": [{"question_number": str, "reasoning": str}], "deductions": [{"issue": str, "points": number, "section": str}]}
+No meaningful issues: empty question_feedback and deductions."""
+
+# Structured-outputs schema matching the OUTPUT section of GRADING_GUIDELINES.
+# Set GRADING_STRICT_SCHEMA=1 on deployments that support it (gpt-4o family)
+# to have Azure enforce the shape instead of plain JSON mode.
+GRADING_STRICT_SCHEMA = os.getenv('GRADING_STRICT_SCHEMA', '0') == '1'
+GRADING_RESPONSE_SCHEMA = {
+    "name": "grading_result",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "score": {"type": "integer"},
+            "feedback": {"type": "string"},
+            "question_feedback": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question_number": {"type": "string"},
+                        "reasoning": {"type": "string"}
+                    },
+                    "required": ["question_number", "reasoning"],
+                    "additionalProperties": False
+                }
+            },
+            "deductions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "issue": {"type": "string"},
+                        "points": {"type": "number"},
+                        "section": {"type": "string"}
+                    },
+                    "required": ["issue", "points", "section"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["score", "feedback", "question_feedback", "deductions"],
+        "additionalProperties": False
+    }
+}
+GRADING_RESPONSE_FORMAT = (
+    {"type": "json_schema", "json_schema": GRADING_RESPONSE_SCHEMA}
+    if GRADING_STRICT_SCHEMA else {"type": "json_object"}
+)
+
+# Student identity markers looked up in each submission, in a single pass.
+# The value is read in a lookahead so the scan resumes right after the key,
+# and a second field on the same line ("NetID: jd123  Name: John Doe") is found.
+INFO_RE = re.compile(
+    r'(?P<key>netid|student\s+id|author|student\s+name|name)\s*[:=](?=\s*(?P<val>[^\n]+))',
+    re.IGNORECASE
+)
+# Identity blocks sit at the top of a submission, so only this much is scanned
+INFO_SCAN_CHARS = 4096
+
+# Cache of grading responses keyed by the exact request sent to the model
+llm_cache = build_cache_from_env()
+
+# Recently graded submissions keyed by model, base file hash and student file hash
+recent_submissions = MemoryBackend(max_entries=int(os.getenv('SUBMISSION_CACHE_SIZE', '256')))
+
+# Submissions graded and how many of them were escalated, reported by /health
+grading_stats = {"graded": 0, "escalated": 0}
+
+
+class DeploymentNotFoundError(Exception):
+    """Raised when the configured Azure deployment name does not exist."""
+
+    def __init__(self, model):
+        super().__init__(f'Deployment "{model}" not found')
+        self.model = model
+
+
+class GradingResponseTooLongError(ValueError):
+    """Raised when a grading answer is cut off even after retrying with a larger cap."""
+
+    def __init__(self, max_tokens):
+        super().__init__(
+            f"Grading response exceeded {max_tokens} tokens; "
+            "increase GRADING_MAX_COMPLETION_TOKENS"
+        )
+        self.max_tokens = max_tokens
+
+
+def save_upload(file_storage, path):
+    """Stream an uploaded file to ``path`` without buffering it in memory."""
+    with open(path, 'wb') as out:
+        shutil.copyfileobj(file_storage.stream, out, length=UPLOAD_CHUNK_SIZE)
+
+
+def upload_to_disk(file_storage, path):
+    """Return a path holding the upload's bytes, writing ``path`` only if needed.
+
+    DiskUploadRequest has already spooled the part to a named temporary file,
+    so that file is used directly instead of being copied a second time.
+    """
+    stream = file_storage.stream
+    spooled_path = getattr(stream, 'name', None)
+    if isinstance(spooled_path, str) and os.path.isfile(spooled_path):
+        stream.flush()
+        return spooled_path
+    save_upload(file_storage, path)
+    return path
+
+
+def file_digest(path):
+    """BLAKE2b digest of a file's bytes, used to recognise resubmissions."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def truncate_for_debug(text, limit=None):
+    """Cap a debug string so large documents don't bloat the JSON response."""
+    limit = DEBUG_TEXT_LIMIT if limit is None else limit
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}\n... [truncated {len(text) - limit} characters]"
+
+
+def parse_grading_response(raw_response):
+    """Decode the model's JSON answer, returning None if it is not a JSON object."""
+    try:
+        result = orjson.loads(raw_response) if orjson else json.loads(raw_response)
+    except (TypeError, ValueError):
+        return None
+    return result if isinstance(result, dict) else None
+
+
+def needs_escalation(result):
+    """Return True when a grading result is malformed or its deductions don't match its score."""
+    if result is None:
+        return True
+    score = result.get('score')
+    deductions = result.get('deductions', [])
+    if isinstance(score, bool) or not isinstance(score, (int, float)) or not isinstance(deductions, list):
+        return True
+    total_deducted = 0
+    for deduction in deductions:
+        points = deduction.get('points') if isinstance(deduction, dict) else None
+        if isinstance(points, bool) or not isinstance(points, (int, float)):
+            return True
+        total_deducted += points
+    return abs(total_deducted - (100 - score)) > GRADING_ESCALATION_TOLERANCE
+
+
+def _get_token_encoding():
+    """Return the tiktoken encoding for the grading deployment, or None if unavailable."""
+    global _token_encoding
+    with _token_encoding_lock:
+        if _token_encoding is None:
+            _token_encoding = False
+            if tiktoken is not None:
+                try:
+                    try:
+                        _token_encoding = tiktoken.encoding_for_model(AZURE_OPENAI_DEPLOYMENT_NAME)
+                    except KeyError:
+                        # Azure deployment names are user-chosen and often not model names
+                        _token_encoding = tiktoken.get_encoding('o200k_base')
+                except Exception as e:
+                    # tiktoken downloads its BPE tables on first use, which fails offline
+                    print(f"tiktoken unavailable, estimating tokens from characters: {e}")
+    return _token_encoding or None
+
+
+def truncate_to_tokens(text, label, max_tokens=None):
+    """Cut ``text`` to the grading token budget, logging when it fires."""
+    max_tokens = GRADING_MAX_INPUT_TOKENS if max_tokens is None else max_tokens
+    if max_tokens <= 0:
+        return text
+    encoding = _get_token_encoding()
+    if encoding is None:
+        # Assume roughly four characters per token
+        max_chars = max_tokens * 4
+        if len(text) <= max_chars:
+            return text
+        print(f"Truncated {label} from {len(text)} to {max_chars} characters")
+        return text[:max_chars]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    print(f"Truncated {label} from {len(tokens)} to {max_tokens} tokens")
+    return encoding.decode(tokens[:max_tokens])
+
+
+def _get_prompt_compressor():
+    """Return the LLMLingua compressor, loading the model on first use, or None if it failed to load."""
+    global _prompt_compressor, _prompt_compressor_failed
+    with _prompt_compressor_lock:
+        if _prompt_compressor is None and not _prompt_compressor_failed:
+            try:
+                _prompt_compressor = PromptCompressor(
+                    model_name=PROMPT_COMPRESSION_MODEL,
+                    device_map=PROMPT_COMPRESSION_DEVICE,
+                    use_llmlingua2=True
+                )
+            except Exception as e:
+                # Don't retry the load on every request; grade uncompressed instead
+                _prompt_compressor_failed = True
+                print(f"Prompt compression disabled, model failed to load: {e}")
+    return _prompt_compressor
+
+
+def compress_content(text):
+    """Shrink a long base solution with LLMLingua when prompt compression is enabled."""
+    if not PROMPT_COMPRESSION_MODEL or PromptCompressor is None:
+        return text
+    if len(text) <= PROMPT_COMPRESSION_THRESHOLD:
+        return text
+    compressor = _get_prompt_compressor()
+    if compressor is None:
+        return text
+    compressed = compressor.compress_prompt(
+        text,
+        rate=PROMPT_COMPRESSION_RATE,
+        # Keep line structure so code and question layout survive
+        force_tokens=['\n'],
+        force_reserve_digit=True
+    )
+    return compressed['compressed_prompt']
+
 
 def _read_as_plain_text(file_path):
     """Best-effort UTF text loader for generic text files."""
@@ -44,28 +409,123 @@ def _read_as_plain_text(file_path):
         return f.read()
 
 
+def _get_pdf_executor():
+    """Return the process pool used for PDF text extraction, creating it on first use."""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            _pdf_executor = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+    return _pdf_executor
+
+
+def _discard_pdf_executor(executor):
+    """Drop a broken PDF pool so the next large PDF starts a fresh one."""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is executor:
+            _pdf_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_docx_text(file_path):
+    """Read body paragraph text straight from a .docx's document.xml.
+
+    Skips python-docx's Paragraph/Run object model; each top-level paragraph's
+    run text, tabs and line breaks are collected from the raw XML instead.
+    Text boxes are left out like python-docx, while runs inside tracked
+    insertions (w:ins) are kept.
+    """
+    with zipfile.ZipFile(file_path) as archive:
+        root = etree.fromstring(archive.read('word/document.xml'), _DOCX_XML_PARSER)
+    body = root.find(_W_BODY)
+    if body is None:
+        return ''
+    text = []
+    for para in body.iterchildren(_W_P):
+        parts = []
+        for el in _W_RUN_TEXT(para):
+            if el.tag == _W_T:
+                # An unexpanded entity reference splits w:t into text and tail
+                parts.append(el.xpath('string()') if len(el) else el.text or '')
+            elif el.tag == _W_TAB:
+                parts.append('\t')
+            elif el.tag == _W_CR or el.get(_W_TYPE, 'textWrapping') == 'textWrapping':
+                parts.append('\n')
+        text.append(''.join(parts))
+    return '\n\n'.join(text)
+
+
+def _calamine_cell_text(value):
+    """Format a calamine cell value the way str() formats openpyxl's value for it."""
+    # calamine reports whole numbers as floats; openpyxl only gives ints for
+    # values Excel wrote without an exponent, i.e. below 1e16
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e16:
+        return str(int(value))
+    # openpyxl reads every date cell as a datetime, so dates print with a midnight time
+    if type(value) is datetime.date:
+        return str(datetime.datetime.combine(value, datetime.time()))
+    return str(value)
+
+
+def _extract_xlsx_calamine(file_path):
+    """Read a workbook with the Rust-backed calamine reader."""
+    wb = CalamineWorkbook.from_path(file_path)
+    text = []
+    for sheet_name in wb.sheet_names:
+        text.append(f"Sheet: {sheet_name}")
+        for row in wb.get_sheet_by_name(sheet_name).to_python():
+            # calamine reports blank cells as ''
+            row_values = [_calamine_cell_text(v) for v in row if v is not None and v != '']
+            if row_values:
+                text.append(" | ".join(row_values))
+    return "\n".join(text)
+
+
 def extract_text(file_path):
     """Extract text from common assignment document formats."""
     ext = os.path.splitext(file_path)[1].lower()
 
     if ext == '.ipynb':
-        nb = nbformat.read(file_path, as_version=4)
+        # Only cell sources are needed, so skip nbformat's schema validation
+        # and read the raw JSON directly.
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        nb = orjson.loads(raw) if orjson else json.loads(raw)
+        if 'cells' not in nb:
+            # Pre-v4 notebooks keep cells under worksheets; let nbformat upgrade them.
+            nb = nbformat.read(file_path, as_version=4)
         text = []
-        for cell in nb.cells:
-            text.append(cell.get('source', ''))
+        for cell in nb['cells']:
+            source = cell.get('source', '')
+            text.append(''.join(source) if isinstance(source, list) else source)
         return '\n\n'.join(text)
     if ext == '.docx':
-        doc = Document(file_path)
-        text = []
-        for para in doc.paragraphs:
-            text.append(para.text)
-        return '\n\n'.join(text)
+        return _extract_docx_text(file_path)
 
     if ext == '.pdf':
         if not PdfReader:
             return _read_as_plain_text(file_path)
         reader = PdfReader(file_path)
-        pages = [(page.extract_text() or "") for page in reader.pages]
+        page_count = len(reader.pages)
+        cpu_count = os.cpu_count() or 1
+        pages = None
+        # A single-CPU host gains nothing from a pool but still pays to spawn it
+        if page_count >= PDF_PARALLEL_MIN_PAGES and cpu_count > 1:
+            # pypdf text extraction is CPU-bound, so split the pages across processes
+            step = -(-page_count // cpu_count)
+            ranges = [(file_path, start, min(start + step, page_count)) for start in range(0, page_count, step)]
+            executor = _get_pdf_executor()
+            try:
+                pages = [text for chunk in executor.map(pdf_worker.extract_pdf_pages, ranges) for text in chunk]
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM-killed); replace the pool and extract inline
+                print(f"PDF worker pool broke on {os.path.basename(file_path)}; extracting inline")
+                _discard_pdf_executor(executor)
+        if pages is None:
+            pages = [(page.extract_text() or "") for page in reader.pages]
         return "\n\n".join(pages)
 
     if ext == '.pptx':
@@ -80,6 +540,8 @@ def extract_text(file_path):
         return "\n\n".join(text)
 
     if ext in {'.xlsx', '.xlsm'}:
+        if CalamineWorkbook:
+            return _extract_xlsx_calamine(file_path)
         if not load_workbook:
             return _read_as_plain_text(file_path)
         wb = load_workbook(file_path, data_only=True)
@@ -92,215 +554,376 @@ def extract_text(file_path):
                     text.append(" | ".join(row_values))
         return "\n".join(text)
 
-    text_like_extensions = {
-        '.txt', '.md', '.csv', '.json', '.jsonl', '.yaml', '.yml', '.xml',
-        '.html', '.htm', '.py', '.js', '.ts', '.java', '.c', '.cpp', '.h',
-        '.sql', '.r', '.tex', '.sh', '.bat', '.log', '.ini', '.cfg', '.toml',
-        '.rtf', '.doc'
-    }
-
-    if ext in text_like_extensions:
+    if ext in _TEXT_LIKE_EXTS:
         return _read_as_plain_text(file_path)
 
     # Last-resort fallback: attempt text decode so unknown formats still get parsed if possible.
     return _read_as_plain_text(file_path)
 
 
+def ojsonify(obj, status=200):
+    """Build a JSON response, encoding with orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+        except TypeError:
+            # orjson rejects a few types the stdlib encoder accepts (e.g. int > 64 bits)
+            pass
+    response = jsonify(obj)
+    response.status_code = status
+    return response
+
+
+def _get_event_loop():
+    """Return the background event loop shared by all grading requests."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='grader-event-loop', daemon=True).start()
+    return _loop
+
+
+def run_async(coro):
+    """Run ``coro`` on the shared event loop and block until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result()
+
+
 def get_azure_client():
-    """Initialize Azure OpenAI client."""
-    api_key = os.getenv('AZURE_OPENAI_API_KEY')
-    endpoint = os.getenv('AZURE_OPENAI_ENDPOINT')
-    api_version = os.getenv('AZURE_OPENAI_API_VERSION', '2024-12-01-preview')
-    
-    if not api_key or not endpoint:
+    """Return the shared Azure OpenAI client, creating it on first use."""
+    global _client
+    if not AZURE_OPENAI_API_KEY or not AZURE_OPENAI_ENDPOINT:
         raise ValueError("AZURE_OPENAI_API_KEY and AZURE_OPENAI_ENDPOINT must be set")
     
-    # Ensure endpoint doesn't have trailing slash
-    endpoint = endpoint.rstrip('/')
-    
-    print(f"Connecting to Azure OpenAI:")
-    print(f"  Endpoint: {endpoint}")
-    print(f"  API Version: {api_version}")
-    
-    return AzureOpenAI(
-        api_key=api_key,
-        api_version=api_version,
-        azure_endpoint=endpoint
-    )
+    with _client_lock:
+        if _client is None:
+            print(f"Connecting to Azure OpenAI:")
+            print(f"  Endpoint: {AZURE_OPENAI_ENDPOINT}")
+            print(f"  API Version: {AZURE_OPENAI_API_VERSION}")
+            
+            # One pooled HTTP client keeps TLS sessions alive across requests
+            _client = AsyncAzureOpenAI(
+                api_key=AZURE_OPENAI_API_KEY,
+                api_version=AZURE_OPENAI_API_VERSION,
+                azure_endpoint=AZURE_OPENAI_ENDPOINT,
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                    timeout=httpx.Timeout(60.0, connect=5.0)
+                )
+            )
+    return _client
 
 
 @app.route('/health')
 def health():
     """Health check endpoint."""
-    return jsonify({'status': 'healthy'}), 200
+    return ojsonify({'status': 'healthy', 'llm_cache': llm_cache.stats, 'grading': grading_stats}, 200)
 
 
 @app.route('/')
 def index():
     """Main page."""
-    has_key = bool(os.getenv('AZURE_OPENAI_API_KEY'))
+    has_key = bool(AZURE_OPENAI_API_KEY)
     return render_template('index.html', has_key=has_key)
 
 
-@app.route('/grade', methods=['POST'])
-def grade():
-    """Grade submissions."""
-    try:
-        # Get files
-        base_file = request.files.get('base_file')
-        student_files = request.files.getlist('student_files')
-        
-        if not base_file or not student_files:
-            return jsonify({'error': 'Missing files'}), 400
-        
-        # Save base file
-        base_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(base_file.filename))
-        base_file.save(base_path)
-        base_content = extract_text(base_path)
-        
-        # Initialize Azure client
-        client = get_azure_client()
-        model = os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME', 'gpt-4')
+async def grade_submissions(client, model, base_content, base_hash, student_files, upload_dir,
+                            include_debug=False, use_cache=True):
+    """Grade every student submission against the base solution concurrently."""
+    # Everything except the student submission is identical across the batch.
+    # Sending it as a leading message keeps the prompt prefix byte-identical so
+    # Azure's automatic prompt caching can reuse it for every student.
+    grading_context = f"{GRADING_GUIDELINES}\n\nBASE SOLUTION (for reference):\n------------------------------\n{base_content}"
+    in_flight = {}
+    
+    async def call_model(api_request):
+        """Send a request to Azure, naming the deployment if it doesn't exist."""
+        try:
+            return await client.chat.completions.create(**api_request)
+        except Exception as e:
+            error_msg = str(e)
+            if "DeploymentNotFound" in error_msg:
+                raise DeploymentNotFoundError(api_request["model"]) from e
+            raise
+    
+    async def request_grade(api_request):
+        """Send one grading request, serving it from the LLM cache when possible.
+
+        Returns the response details, the parsed result (None if it is not a
+        JSON object) and whether the answer came from the cache.
+        """
+        # Requests that set a sampling temperature are never served from the cache;
+        # the grading request leaves it unset
+        cacheable = api_request.get("temperature", 0) <= 0
+        cache_key = LLMCache.make_key(api_request)
+        cached = await llm_cache.get(cache_key) if cacheable and use_cache else None
+        if cached is not None:
+            result = parse_grading_response(cached["raw_response"])
+            if result is not None:
+                return cached, result, True
         
-        print(f"Using deployment: {model}")
+        response = await call_model(api_request)
+        if response.choices[0].finish_reason == 'length':
+            # A verbose answer gets one retry with twice the room before it is given up on
+            max_tokens = api_request["max_completion_tokens"] * 2
+            response = await call_model({**api_request, "max_completion_tokens": max_tokens})
+            if response.choices[0].finish_reason == 'length':
+                raise GradingResponseTooLongError(max_tokens)
         
-        # Grade each student file
-        results = []
-        for student_file in student_files:
-            if not student_file.filename:
-                continue
-            
-            student_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(student_file.filename))
-            student_file.save(student_path)
-            student_content = extract_text(student_path)
+        usage = getattr(response, 'usage', None)
+        cached = {
+            "raw_response": response.choices[0].message.content,
+            "model_used": getattr(response, 'model', api_request["model"]),
+            "finish_reason": response.choices[0].finish_reason,
+            "usage": {
+                "prompt_tokens": usage.prompt_tokens if usage else None,
+                "completion_tokens": usage.completion_tokens if usage else None,
+                "total_tokens": usage.total_tokens if usage else None
+            }
+        }
+        # Only answers that parse are cached; a malformed one is retried next time
+        result = parse_grading_response(cached["raw_response"])
+        if cacheable and result is not None:
+            await llm_cache.set(cache_key, cached)
+        return cached, result, False
+    
+    async def grade_content(student_path, submission_key, filename):
+        """Extract and grade one distinct submission file."""
+        async with azure_semaphore:
+            previous = await recent_submissions.get(submission_key) if use_cache else None
+            if previous is not None:
+                info_text = previous["info_text"]
+                prompt_content = previous["prompt_content"]
+            else:
+                student_content = await asyncio.to_thread(extract_text, student_path)
+                # Only the head is needed for identity lookup, so the full text isn't kept
+                info_text = student_content[:INFO_SCAN_CHARS]
+                prompt_content = await asyncio.to_thread(
+                    truncate_to_tokens, student_content, f"submission {filename}"
+                )
+                del student_content
             
             # Grade with Azure OpenAI
-            prompt = f"""You are grading a student's submission against a reference solution.
-
-IMPORTANT GRADING GUIDELINES:
-- Do NOT penalize minor style differences or variable naming.
-- Partial credit is encouraged when the approach is reasonable.
-- Focus on correctness, logic, and completeness over exact matching.
-
-BASE SOLUTION (for reference):
-------------------------------
-{base_content}
-
-STUDENT SUBMISSION:
--------------------
-{student_content}
-
-EVALUATION CRITERIA:
-1. Correctness of core logic and results
-2. Completeness of the solution
-3. Reasonable handling of edge cases
-4. Clarity of explanations or comments (if applicable)
-
-SCORING RULES:
-- Start from 100 points.
-- Deduct points ONLY for clear mistakes or missing components.
-- Small issues should incur small deductions (1–5 points).
-- Larger conceptual errors may incur larger deductions.
-- Do not invent issues if the solution is acceptable.
-
-OUTPUT FORMAT:
-Respond ONLY in valid JSON with the following structure:
-
-{{
-  "score": xx,
-  "feedback": "<brief, constructive summary of strengths and weaknesses>",
-  "question_feedback": [
-    {{"question_number": "1", "reasoning": " "}},
-    {{"question_number": "2", "reasoning": " "}}
-  ],
-  "deductions": [
-    {{"issue": " ", "points": x, "section": " "}},
-    {{"issue": " ", "points": x, "section": " "}}
-  ]
-}}
-
-If there are no meaningful issues, return empty question_feedback and deductions lists."""
-
+            prompt = f"STUDENT SUBMISSION:\n-------------------\n{prompt_content}"
+            
             # Prepare API request details for debugging
-            system_message = "You are a grading assistant. Always respond with valid JSON."
+            messages = [
+                {"role": "system", "content": SYSTEM_MESSAGE},
+                {"role": "system", "content": grading_context},
+                {"role": "user", "content": prompt}
+            ]
             api_request = {
                 "model": model,
-                "messages": [
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": prompt}
-                ],
-                "response_format": {"type": "json_object"}
+                "messages": messages,
+                "response_format": GRADING_RESPONSE_FORMAT,
+                "max_completion_tokens": GRADING_MAX_COMPLETION_TOKENS
             }
             
-            try:
-                response = client.chat.completions.create(**api_request)
-            except Exception as e:
-                error_msg = str(e)
-                if "DeploymentNotFound" in error_msg:
-                    return jsonify({
-                        'error': f'Deployment "{model}" not found. Check AZURE_OPENAI_DEPLOYMENT_NAME in .env file. Available deployments can be found in Azure Portal.'
-                    }), 400
-                raise
+            if previous is not None:
+                cached = previous["response"]
+                cache_hit = True
+                api_request["model"] = previous["model"]
+                escalated = previous["model"] != model
+                result = parse_grading_response(cached["raw_response"])
+            else:
+                cached, result, cache_hit = await request_grade(api_request)
+                escalated = False
+                if (AZURE_OPENAI_ESCALATION_DEPLOYMENT and AZURE_OPENAI_ESCALATION_DEPLOYMENT != model
+                        and needs_escalation(result)):
+                    print(f"Escalating {filename} to {AZURE_OPENAI_ESCALATION_DEPLOYMENT}")
+                    api_request["model"] = AZURE_OPENAI_ESCALATION_DEPLOYMENT
+                    cached, result, cache_hit = await request_grade(api_request)
+                    escalated = True
+            
+            if result is None:
+                raise ValueError(f"Grading response for {filename} was not a JSON object")
             
-            raw_response = response.choices[0].message.content
-            result = json.loads(raw_response)
+            if previous is None:
+                # Only grades fresh from the model count, so cache replays and
+                # failures don't skew the escalation rate
+                if not cache_hit:
+                    grading_stats["graded"] += 1
+                    if escalated:
+                        grading_stats["escalated"] += 1
+                # Remembered for as long as the LLM cache would keep the answer
+                await recent_submissions.set(submission_key, {
+                    "info_text": info_text,
+                    "prompt_content": prompt_content,
+                    "response": cached,
+                    "model": api_request["model"]
+                }, ttl=llm_cache.ttl)
+            raw_response = cached["raw_response"]
             
-            # Collect debug information
-            debug_info = {
-                "api_request": {
-                    "model": model,
-                    "endpoint": os.getenv('AZURE_OPENAI_ENDPOINT'),
-                    "api_version": os.getenv('AZURE_OPENAI_API_VERSION', '2024-12-01-preview'),
-                    "system_message": system_message,
-                    "user_prompt": prompt,
-                    "prompt_length": len(prompt),
-                    "temperature": 1
-                },
-                "api_response": {
-                    "model_used": response.model if hasattr(response, 'model') else model,
-                    "finish_reason": response.choices[0].finish_reason,
-                    "raw_response": raw_response,
-                    "usage": {
-                        "prompt_tokens": response.usage.prompt_tokens if hasattr(response, 'usage') else None,
-                        "completion_tokens": response.usage.completion_tokens if hasattr(response, 'usage') else None,
-                        "total_tokens": response.usage.total_tokens if hasattr(response, 'usage') else None
+            # Collect debug information; the full payload echoes both documents,
+            # so it is only sent when asked for
+            prompt_length = len(grading_context) + len(prompt)
+            if include_debug:
+                debug_info = {
+                    "api_request": {
+                        "model": api_request["model"],
+                        "endpoint": AZURE_OPENAI_ENDPOINT,
+                        "api_version": AZURE_OPENAI_API_VERSION,
+                        "system_message": SYSTEM_MESSAGE,
+                        "grading_context": truncate_for_debug(grading_context),
+                        "user_prompt": truncate_for_debug(prompt),
+                        "prompt_length": prompt_length,
+                        "temperature": 1
+                    },
+                    "api_response": {
+                        "model_used": cached["model_used"],
+                        "finish_reason": cached["finish_reason"],
+                        "raw_response": truncate_for_debug(raw_response),
+                        "usage": cached["usage"],
+                        "cache_hit": cache_hit,
+                        "escalated": escalated
                     }
-                },
-                "parsed_result": result
-            }
+                }
+            else:
+                # The result fields already carry the parsed answer, so the summary
+                # only identifies the prompt instead of echoing it. Both lengths are
+                # of the text actually sent, after compression and truncation.
+                debug_info = {
+                    "prompt_length": prompt_length,
+                    "base_content_length": len(base_content),
+                    "student_content_length": len(prompt_content),
+                    "prompt_sha256": hashlib.sha256((grading_context + prompt).encode()).hexdigest(),
+                    "usage": cached["usage"],
+                    "escalated": escalated
+                }
             
-            # Try to extract student name/ID from content
-            filename = student_file.filename
-            student_name = filename.split('.')[0] if '.' in filename else filename
-            student_id = None
+            return {"info_text": info_text, "result": result, "debug": debug_info}
+    
+    async def grade_one(index, student_file):
+        """Grade a single student submission, sharing work with identical files."""
+        if not student_file.filename:
+            return None
+        
+        filename = student_file.filename
+        # Prefix with the upload index so same-named files don't clobber each other
+        student_path = await asyncio.to_thread(
+            upload_to_disk,
+            student_file,
+            os.path.join(upload_dir, f"{index}_{secure_filename(filename)}")
+        )
+        
+        # Identical resubmissions against the same base skip extraction and grading
+        student_hash = await asyncio.to_thread(file_digest, student_path)
+        student_ext = os.path.splitext(student_path)[1].lower()
+        submission_key = f"{model}:{base_hash}:{student_hash}{student_ext}"
+        
+        if student_hash == base_hash:
+            # An unmodified copy of the base solution needs no model call
+            graded = {
+                "info_text": (await asyncio.to_thread(extract_text, student_path))[:INFO_SCAN_CHARS],
+                "result": {"score": 100, "feedback": "Submission is identical to the base solution."},
+                "debug": {"identical_to_base": True}
+            }
+        else:
+            # Byte-identical files in one batch share a single grading task
+            task = in_flight.get(submission_key)
+            if task is None:
+                task = in_flight[submission_key] = asyncio.ensure_future(
+                    grade_content(student_path, submission_key, filename)
+                )
+            try:
+                graded = await task
+            except GradingResponseTooLongError as e:
+                # Reported on this submission alone so the rest of the batch is kept
+                return {'filename': filename, 'error': str(e)}
+        info_text = graded["info_text"]
+        result = graded["result"]
+        
+        # Try to extract student name/ID from content
+        student_name = filename.split('.')[0] if '.' in filename else filename
+        student_id = None
+        
+        # Look for student info in content (simple extraction)
+        name_found = False
+        for match in INFO_RE.finditer(info_text):
+            key = match.group('key').lower()
+            value = match.group('val').strip()
+            if not value:
+                continue
+            if key.endswith('id'):
+                if student_id is None:
+                    student_id = value.split()[0]
+            elif not name_found:
+                student_name = value
+                name_found = True
+            if student_id is not None and name_found:
+                break
+        
+        return {
+            'filename': filename,
+            'student_name': student_name,
+            'student_id': student_id,
+            'score': result.get('score', 0),
+            'feedback': result.get('feedback', ''),
+            'question_feedback': result.get('question_feedback', []),
+            'deductions': result.get('deductions', []),
+            'debug': graded["debug"]
+        }
+    
+    # Each call is dominated by network latency, so dispatch them all at once
+    outcomes = await asyncio.gather(
+        *(grade_one(i, f) for i, f in enumerate(student_files)),
+        return_exceptions=True
+    )
+    
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+        if outcome is not None:
+            results.append(outcome)
+    return results
+
+
+@app.route('/grade', methods=['POST'])
+def grade():
+    """Grade submissions."""
+    try:
+        # Get files
+        base_file = request.files.get('base_file')
+        student_files = request.files.getlist('student_files')
+        
+        if not base_file or not student_files:
+            return ojsonify({'error': 'Missing files'}, 400)
+        
+        # Full prompts and raw responses are only returned with ?debug=1
+        include_debug = request.args.get('debug') == '1'
+        # ?no_cache=1 forces a fresh grade; the new response still refreshes the caches
+        use_cache = request.args.get('no_cache') != '1'
+        
+        # Uploads live in a per-request directory that is removed with the response,
+        # so student files never outlive the request
+        with tempfile.TemporaryDirectory(prefix='grader-') as upload_dir:
+            # Save base file
+            base_path = upload_to_disk(base_file, os.path.join(upload_dir, secure_filename(base_file.filename)))
+            base_content = truncate_to_tokens(compress_content(extract_text(base_path)), "base solution")
+            base_hash = file_digest(base_path)
             
-            # Look for student info in content (simple extraction)
-            content_lower = student_content.lower()
-            if 'netid' in content_lower or 'student id' in content_lower:
-                netid_match = re.search(r'(?:netid|student\s+id)\s*[:=]\s*(\S+)', student_content, re.IGNORECASE)
-                if netid_match:
-                    student_id = netid_match.group(1).strip()
+            # Initialize Azure client
+            client = get_azure_client()
+            model = AZURE_OPENAI_DEPLOYMENT_NAME
             
-            if 'author' in content_lower or 'name' in content_lower:
-                name_match = re.search(r'(?:author|name|student\s+name)\s*[:=]\s*([^\n]+)', student_content, re.IGNORECASE)
-                if name_match:
-                    student_name = name_match.group(1).strip()
+            print(f"Using deployment: {model}")
             
-            results.append({
-                'filename': filename,
-                'student_name': student_name,
-                'student_id': student_id,
-                'score': result.get('score', 0),
-                'feedback': result.get('feedback', ''),
-                'question_feedback': result.get('question_feedback', []),
-                'deductions': result.get('deductions', []),
-                'debug': debug_info
-            })
+            try:
+                results = run_async(grade_submissions(
+                    client, model, base_content, base_hash, student_files, upload_dir,
+                    include_debug=include_debug, use_cache=use_cache
+                ))
+            except DeploymentNotFoundError as e:
+                setting = 'AZURE_OPENAI_DEPLOYMENT_NAME' if e.model == model else 'AZURE_OPENAI_ESCALATION_DEPLOYMENT'
+                return ojsonify({
+                    'error': f'Deployment "{e.model}" not found. Check {setting} in .env file. Available deployments can be found in Azure Portal.'
+                }, 400)
         
-        return jsonify({'results': results})
+        return ojsonify({'results': results})
     
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 
 if __name__ == '__main__':
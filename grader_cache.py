@@ -0,0 +1,226 @@
+"""Content-addressed cache for Azure OpenAI grading responses."""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from typing import Optional, Protocol
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover
+    aioredis = None
+
+
+class CacheBackend(Protocol):
+    """Storage used by LLMCache."""
+
+    async def get(self, key: str) -> Optional[dict]:
+        ...
+
+    async def set(self, key: str, value: dict, ttl: Optional[int] = None) -> None:
+        ...
+
+
+class MemoryBackend:
+    """In-process LRU cache, optionally mirrored to a JSON file for dev reruns."""
+
+    def __init__(self, max_entries=1024, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._persist_lock = threading.Lock()
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, (expires_at, value) in stored.items():
+            self._entries[key] = (expires_at, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _persist(self):
+        # Snapshot under the write lock so the last write always holds the newest entries
+        with self._persist_lock:
+            with self._lock:
+                snapshot = dict(self._entries)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+
+    async def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self.path:
+            # Rewriting the file off the event loop keeps other grades moving
+            await asyncio.to_thread(self._persist)
+
+
+class SqliteBackend:
+    """On-disk cache in a SQLite file; safe to share between worker processes."""
+
+    def __init__(self, path, max_entries=None):
+        self.path = path
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _get(self, key):
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at < time.time():
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+        return json.loads(value)
+
+    def _set(self, key, value, ttl):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at)
+            )
+            conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+            if self.max_entries:
+                # INSERT OR REPLACE assigns a fresh rowid, so the lowest rowids are the oldest writes
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE rowid NOT IN "
+                    "(SELECT rowid FROM llm_cache ORDER BY rowid DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+
+    async def get(self, key):
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key, value, ttl=None):
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+
+class RedisBackend:
+    """Shared cache backed by Redis, for multi-process deployments."""
+
+    def __init__(self, url, prefix="grader:llm:"):
+        if aioredis is None:
+            raise RuntimeError("redis package is required for RedisBackend")
+        self.url = url
+        self.prefix = prefix
+        # One pooled client for every lookup; connections are opened lazily
+        self._client = aioredis.from_url(url)
+
+    async def get(self, key):
+        raw = await self._client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key, value, ttl=None):
+        # Redis rejects ex=0; a TTL of 0 means "never expire", as in the other backends
+        await self._client.set(self.prefix + key, json.dumps(value), ex=ttl if ttl and ttl > 0 else None)
+
+
+class LLMCache:
+    """Looks up grading responses by a hash of the exact request sent to the model."""
+
+    def __init__(self, backend: CacheBackend, ttl=3600):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    @staticmethod
+    def make_key(api_request):
+        """Hash every field of the request, so any change to model, prompt or options misses."""
+        if orjson is not None:
+            payload = orjson.dumps(api_request, option=orjson.OPT_SORT_KEYS)
+        else:
+            payload = json.dumps(api_request, sort_keys=True).encode()
+        return hashlib.sha256(payload).hexdigest()
+
+    async def get(self, key):
+        # The cache is an optimisation; a backend failure counts as a miss
+        try:
+            value = await self.backend.get(key)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"LLM cache lookup failed, treating as a miss: {e}")
+            value = None
+        if value is None:
+            self.stats["misses"] += 1
+        else:
+            self.stats["hits"] += 1
+        return value
+
+    async def set(self, key, value, ttl=None):
+        try:
+            await self.backend.set(key, value, ttl=ttl if ttl is not None else self.ttl)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"LLM cache write failed, skipping: {e}")
+
+
+def build_cache_from_env():
+    """Create the LLM cache configured by environment variables."""
+    ttl = int(os.getenv('LLM_CACHE_TTL', '3600'))
+    max_entries = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '1024'))
+    redis_url = os.getenv('REDIS_URL')
+    if redis_url:
+        if aioredis is not None:
+            return LLMCache(RedisBackend(redis_url), ttl=ttl)
+        print("REDIS_URL is set but the redis package is not installed; "
+              "falling back to a per-process cache (pip install redis)")
+
+    path = os.getenv('LLM_CACHE_PATH') or None
+    if path and path.endswith(('.db', '.sqlite', '.sqlite3')):
+        return LLMCache(SqliteBackend(path, max_entries=max_entries), ttl=ttl)
+
+    backend = MemoryBackend(max_entries=max_entries, path=path)
+    return LLMCache(backend, ttl=ttl)
@@ -0,0 +1,14 @@
+"""PDF text extraction run in worker processes.
+
+Kept apart from app.py so spawned workers only import pypdf, not the Flask
+app, the Azure client or the LLM cache.
+"""
+
+from pypdf import PdfReader
+
+
+def extract_pdf_pages(args):
+    """Extract text for a contiguous range of PDF pages."""
+    file_path, start, stop = args
+    reader = PdfReader(file_path)
+    return [(reader.pages[i].extract_text() or "") for i in range(start, stop)]